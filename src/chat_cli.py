@@ -2,30 +2,88 @@ import os
 
 # import readline
 import atexit
-import yaml
+from concurrent.futures import Future
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator
 from rich.console import Console
 from rich.markdown import Markdown
-from rich.panel import Panel
 from rich.prompt import Prompt
-from rich.table import Table
-from openai import OpenAI
 from database import DatabaseManager, ChatMessage, ChatSession
+from utils import load_yaml_cached
+
+
+class StreamingPanel:
+    """Live renderable for a reply that is still streaming in.
+
+    The Markdown is parsed when Live refreshes rather than on every delta,
+    and only the tail that fits the terminal is drawn so new tokens stay
+    visible on long replies.
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+        self.text = ""
+        self._cache_key = None
+        self._lines: List = []
+
+    def __rich_console__(self, console, options):
+        from rich.panel import Panel
+        from rich.segment import Segment, Segments
+
+        # Panel borders and padding take two columns on each side
+        width = max(options.max_width - 4, 1)
+        if self._cache_key != (len(self.text), width):
+            self._lines = console.render_lines(
+                Markdown(self.text), options.update_width(width), pad=False
+            )
+            self._cache_key = (len(self.text), width)
+        # Leave room for the panel's top and bottom borders
+        tail = self._lines[-max(console.size.height - 3, 1) :]
+        segments = [segment for line in tail for segment in (*line, Segment.line())]
+        yield Panel(Segments(segments), title=self.title)
 
 
 class ChatCLI:
     def __init__(self, config: dict):
         self.config = config
         self.db = DatabaseManager(config["database_file"])
+        atexit.register(self.db.close)
         self.api_key = config["api_key"]
         self.base_url = config["base_url"]
         self.current_model = config["default_model"]
+        self.history_window = config.get("history_window")
+        if (
+            not isinstance(self.history_window, int)
+            or isinstance(self.history_window, bool)
+            or self.history_window <= 0
+        ):
+            self.history_window = 20
         self.history_file = os.path.expanduser(config["history_file"])
         self.current_session_id = None
+        self.current_messages: List[Dict] = []
+        self._pending_writes: List[Future] = []
+        self._client = None
         self.console = Console()
         self.load_history()
         self.load_models_from_yaml("models.yaml")
+        self._known_models = {name for name, _ in self.db.get_all_models()}
+
+    @property
+    def client(self):
+        # openai/httpx are slow to import, so defer them until the first API call
+        if self._client is None:
+            import httpx
+            from openai import OpenAI
+
+            self._client = OpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                http_client=httpx.Client(
+                    limits=httpx.Limits(max_keepalive_connections=4)
+                ),
+            )
+            atexit.register(self._client.close)
+        return self._client
 
     def load_history(self):
         if os.path.exists(self.history_file):
@@ -35,10 +93,13 @@ class ChatCLI:
 
     def load_models_from_yaml(self, models_file: str):
         if os.path.exists(models_file):
-            with open(models_file, "r") as f:
-                data = yaml.safe_load(f)
-                for model in data.get("models", []):
-                    self.db.insert_model(model["name"], model.get("description", ""))
+            data = load_yaml_cached(models_file)
+            self.db.insert_models_bulk(
+                [
+                    (model["name"], model.get("description", ""))
+                    for model in data.get("models", [])
+                ]
+            )
 
     def display_welcome(self):
         welcome_text = """
@@ -58,6 +119,8 @@ Available commands:
         self.console.print(Markdown(welcome_text))
 
     def display_models(self):
+        from rich.table import Table
+
         table = Table(title="Available Models")
         table.add_column("Model Name")
         table.add_column("Description")
@@ -66,6 +129,8 @@ Available commands:
         self.console.print(table)
 
     def display_sessions(self):
+        from rich.table import Table
+
         table = Table(title="Chat Sessions")
         table.add_column("ID")
         table.add_column("Start Time")
@@ -82,6 +147,8 @@ Available commands:
         self.console.print(table)
 
     def display_chat_history(self, session: ChatSession):
+        from rich.panel import Panel
+
         for msg in session.messages:
             role_color = "green" if msg.role == "assistant" else "blue"
             self.console.print(
@@ -92,16 +159,68 @@ Available commands:
                 )
             )
 
-    def call_ai_api(self, messages: List[Dict]) -> Optional[str]:
-        client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+    def call_ai_api(self, messages: List[Dict]) -> Iterator[str]:
+        client = self.client
+        import httpx
+        from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+        streamed = False
         try:
             response = client.chat.completions.create(
-                model=self.current_model, messages=messages
+                model=self.current_model, messages=messages, stream=True
             )
-            return response.choices[0].message.content
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    streamed = True
+                    yield delta
+        except (APIStatusError, APITimeoutError) as e:
+            # Rejected requests (bad key, unknown model, rate limit) and
+            # timeouts would fail the same way without streaming
+            self.console.print(f"[red]Error calling AI API: {e}[/]")
+        except (APIConnectionError, httpx.TransportError, ValueError) as e:
+            if streamed:
+                self.console.print(f"[red]Error calling AI API: {e}[/]")
+                return
+            # The stream broke or couldn't be decoded before any content
+            # arrived, so retry once without streaming
+            try:
+                response = client.chat.completions.create(
+                    model=self.current_model, messages=messages
+                )
+                content = response.choices[0].message.content
+                if content:
+                    yield content
+            except Exception as e:
+                self.console.print(f"[red]Error calling AI API: {e}[/]")
         except Exception as e:
             self.console.print(f"[red]Error calling AI API: {e}[/]")
-            return None
+
+    def request_messages(self) -> List[Dict]:
+        messages = self.current_messages[-self.history_window :]
+        # Some providers require the conversation to open with a user turn
+        start = 0
+        while start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+        return messages[start:]
+
+    def save_message(self, message: ChatMessage):
+        self._pending_writes.append(
+            self.db.add_message_async(self.current_session_id, message)
+        )
+
+    def report_failed_writes(self):
+        pending = []
+        for future in self._pending_writes:
+            if not future.done():
+                pending.append(future)
+            elif future.exception():
+                self.console.print(
+                    f"[red]A message could not be saved to the database: {future.exception()}[/]"
+                )
+        self._pending_writes = pending
 
     def process_command(self, command: str) -> bool:
         if command == "/exit":
@@ -110,8 +229,7 @@ Available commands:
             self.display_models()
         elif command.startswith("/switch_model "):
             model = command.split(" ", 1)[1]
-            models = [m[0] for m in self.db.get_all_models()]
-            if model in models:
+            if model in self._known_models:
                 self.current_model = model
                 if self.current_session_id:
                     self.db.update_session_model(self.current_session_id, model)
@@ -123,6 +241,7 @@ Available commands:
             self.current_session_id = self.db.create_session(
                 self.current_model, title=title
             )
+            self.current_messages = []
             self.console.print(
                 f"[green]Created new session: {self.current_session_id}[/]"
             )
@@ -135,6 +254,10 @@ Available commands:
                 if session:
                     self.current_session_id = session_id
                     self.current_model = session.current_model
+                    self.current_messages = [
+                        {"role": msg.role, "content": msg.content}
+                        for msg in session.messages
+                    ]
                     self.console.print(f"[green]Switched to session: {session_id}[/]")
                     self.display_chat_history(session)
                 else:
@@ -156,7 +279,7 @@ Available commands:
                 confirm = Prompt.ask(
                     f"Are you sure you want to delete session {session_id}? (yes/no)"
                 )
-                if confirm.lower() == "yes" or "y":
+                if confirm.strip().lower() in ("yes", "y"):
                     self.db.delete_session(session_id)
                     self.console.print(
                         f"[green]Session {session_id} deleted successfully.[/]"
@@ -165,6 +288,7 @@ Available commands:
                         self.current_session_id = self.db.create_session(
                             self.current_model, "New Session"
                         )
+                        self.current_messages = []
                         self.console.print(
                             f"[green]Switched to new session: {self.current_session_id}[/]"
                         )
@@ -181,6 +305,10 @@ Available commands:
         return True
 
     def run(self):
+        from rich.live import Live
+        from rich.panel import Panel
+        from rich.spinner import Spinner
+
         self.display_welcome()
         if not self.current_session_id:
             self.current_session_id = self.db.create_session(
@@ -188,6 +316,7 @@ Available commands:
             )
         running = True
         while running:
+            self.report_failed_writes()
             try:
                 user_input = Prompt.ask("\n[blue]You[/]").strip()
                 if not user_input:
@@ -201,14 +330,24 @@ Available commands:
                     timestamp=datetime.now(),
                     model=self.current_model,
                 )
-                self.db.add_message(self.current_session_id, user_msg)
-                session = self.db.get_session(self.current_session_id)
-                messages = [
-                    {"role": msg.role, "content": msg.content}
-                    for msg in session.messages
-                ]
-                with self.console.status("[bold green]AI is thinking..."):
-                    response = self.call_ai_api(messages)
+                self.save_message(user_msg)
+                self.current_messages.append({"role": "user", "content": user_input})
+                response = ""
+                title = f"[green]AI ({self.current_model})[/]"
+                # Transient so a failed request leaves no empty panel behind;
+                # the finished response is printed once below
+                with Live(
+                    Spinner("dots", text="[bold green]AI is thinking..."),
+                    console=self.console,
+                    refresh_per_second=15,
+                    transient=True,
+                ) as live:
+                    stream = StreamingPanel(title)
+                    for delta in self.call_ai_api(self.request_messages()):
+                        if not response:
+                            live.update(stream)
+                        response += delta
+                        stream.text = response
                 if response:
                     ai_msg = ChatMessage(
                         role="assistant",
@@ -216,17 +355,22 @@ Available commands:
                         timestamp=datetime.now(),
                         model=self.current_model,
                     )
-                    self.db.add_message(self.current_session_id, ai_msg)
                     self.console.print(
                         Panel(
                             Markdown(response),
-                            title=f"[green]AI ({self.current_model})[/]",
+                            title=title,
                             subtitle=f"[dim]{ai_msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')}[/]",
                         )
                     )
+                    self.save_message(ai_msg)
+                    self.current_messages.append(
+                        {"role": "assistant", "content": response}
+                    )
                 else:
                     self.console.print("[red]Failed to get AI response[/]")
             except KeyboardInterrupt:
                 self.console.print("\n[yellow]Use /exit to quit[/]")
             except Exception as e:
                 self.console.print(f"[red]Error: {e}[/]")
+        self.db.flush()
+        self.report_failed_writes()
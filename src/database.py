@@ -1,12 +1,32 @@
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from dataclasses import dataclass
-from typing import List, Tuple, Optional
+from typing import Callable, Dict, Iterator, List, Tuple, Optional
 from rich.console import Console
 
 console = Console()
 
 
+def adapt_datetime(val):
+    return val.isoformat()
+
+
+def convert_datetime(val):
+    try:
+        return datetime.fromisoformat(val.decode())
+    except AttributeError:
+        return datetime.fromisoformat(val)
+
+
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter("DATETIME", convert_datetime)
+
+
 @dataclass
 class ChatMessage:
     role: str
@@ -23,167 +43,281 @@ class ChatSession:
     messages: List[ChatMessage]
 
 
+WRITE_RETRIES = 3
+
+# Model names are not foreign keys: sessions and messages may use a model
+# that isn't listed in models.yaml (e.g. the configured default_model)
+SESSIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_time DATETIME NOT NULL,
+        current_model TEXT NOT NULL,
+        title TEXT,
+        description TEXT
+    )
+"""
+
+MESSAGES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER NOT NULL,
+        timestamp DATETIME NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        model TEXT NOT NULL,
+        metadata TEXT,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+    )
+"""
+
+
 class DatabaseManager:
     def __init__(self, db_file: str):
         self.db_file = db_file
+        self._conn = self.connect()
+        journal_mode = self._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            console.print(
+                f"[yellow]WAL mode unavailable, using journal_mode={journal_mode}[/]"
+            )
         self.initialize_database()
+        self._write_q: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
 
-    def get_connection(self) -> sqlite3.Connection:
-        def adapt_datetime(val):
-            return val.isoformat()
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_file,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
 
-        def convert_datetime(val):
+    def _write_loop(self):
+        # Background writes use their own connection so they never interleave
+        # with a transaction open on the main one
+        conn = self.connect()
+        while True:
+            item = self._write_q.get()
             try:
-                return datetime.fromisoformat(val.decode())
-            except AttributeError:
-                return datetime.fromisoformat(val)
+                if item is None:
+                    break
+                op, future = item
+                self._run_write(conn, op, future)
+            finally:
+                self._write_q.task_done()
+        conn.close()
 
-        sqlite3.register_adapter(datetime, adapt_datetime)
-        sqlite3.register_converter("DATETIME", convert_datetime)
+    def _run_write(
+        self,
+        conn: sqlite3.Connection,
+        op: Callable[[sqlite3.Connection], None],
+        future: Future,
+    ):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                op(conn)
+            except sqlite3.OperationalError as e:
+                # Usually a locked database; back off and try again
+                if attempt == WRITE_RETRIES - 1:
+                    future.set_exception(e)
+                    return
+                time.sleep(0.1 * 2**attempt)
+            except Exception as e:
+                # Anything else won't succeed on retry; hand it to the caller
+                # so the writer thread keeps running
+                future.set_exception(e)
+                return
+            else:
+                future.set_result(None)
+                return
 
-        return sqlite3.connect(
-            self.db_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-        )
+    def flush(self):
+        self._write_q.join()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        self._conn.execute("BEGIN")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        self._write_q.put(None)
+        self._writer.join()
+        self._conn.close()
 
     def initialize_database(self):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS models (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    description TEXT
+        # Foreign keys stay off while the schema is created or migrated, so
+        # rebuilding chat_sessions doesn't cascade into chat_messages
+        self._conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            with self.transaction() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS models (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT UNIQUE NOT NULL,
+                        description TEXT
+                    )
+                """)
+                conn.execute(SESSIONS_TABLE_SQL.format(table="chat_sessions"))
+                conn.execute(MESSAGES_TABLE_SQL.format(table="chat_messages"))
+                self.migrate_schema(conn)
+                conn.execute(
+                    """CREATE INDEX IF NOT EXISTS idx_messages_session_ts
+                       ON chat_messages(session_id, timestamp)"""
                 )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    start_time DATETIME NOT NULL,
-                    current_model TEXT NOT NULL,
-                    title TEXT,
-                    description TEXT,
-                    FOREIGN KEY (current_model) REFERENCES models(name)
+                conn.execute(
+                    """CREATE INDEX IF NOT EXISTS idx_sessions_start
+                       ON chat_sessions(start_time DESC)"""
                 )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id INTEGER NOT NULL,
-                    timestamp DATETIME NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    model TEXT NOT NULL,
-                    metadata TEXT,
-                    FOREIGN KEY (session_id) REFERENCES chat_sessions(id),
-                    FOREIGN KEY (model) REFERENCES models(name)
-                )
-            """)
+        finally:
+            self._conn.execute("PRAGMA foreign_keys=ON")
 
-    def insert_model(self, name: str, description: str = ""):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(
-                    "INSERT INTO models (name, description) VALUES (?, ?)",
-                    (name, description),
-                )
-            except sqlite3.IntegrityError:
-                console.print(f"[yellow]Model '{name}' already exists[/]")
+    def migrate_schema(self, conn: sqlite3.Connection):
+        # Older databases reference models(name) and lack ON DELETE CASCADE;
+        # SQLite can't alter constraints, so the affected tables are rebuilt
+        if "current_model" in self._foreign_keys(conn, "chat_sessions"):
+            self._rebuild_table(
+                conn,
+                "chat_sessions",
+                SESSIONS_TABLE_SQL,
+                "id, start_time, current_model, title, description",
+                "FROM chat_sessions",
+            )
+        message_fks = self._foreign_keys(conn, "chat_messages")
+        if "model" in message_fks or message_fks.get("session_id") != "CASCADE":
+            self._rebuild_table(
+                conn,
+                "chat_messages",
+                MESSAGES_TABLE_SQL,
+                "id, session_id, timestamp, role, content, model, metadata",
+                """FROM chat_messages
+                   WHERE session_id IN (SELECT id FROM chat_sessions)""",
+            )
+
+    def _foreign_keys(self, conn: sqlite3.Connection, table: str) -> Dict[str, str]:
+        # Maps each referencing column to its ON DELETE action
+        return {
+            row[3]: row[6]
+            for row in conn.execute(f"PRAGMA foreign_key_list({table})")
+        }
+
+    def _rebuild_table(
+        self,
+        conn: sqlite3.Connection,
+        table: str,
+        create_sql: str,
+        columns: str,
+        source: str,
+    ):
+        conn.execute(create_sql.format(table=f"{table}_new"))
+        conn.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} {source}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    def insert_models_bulk(self, rows: List[Tuple[str, str]]):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO models (name, description) VALUES (?, ?)",
+                rows,
+            )
 
     def get_all_models(self) -> List[Tuple[str, str]]:
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name, description FROM models")
-            return cursor.fetchall()
+        return self._conn.execute("SELECT name, description FROM models").fetchall()
 
     def create_session(self, model: str, title: str = "", description: str = "") -> int:
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """INSERT INTO chat_sessions
-                   (start_time, current_model, title, description)
-                   VALUES (?, ?, ?, ?)""",
-                (datetime.now(), model, title, description),
-            )
-            return cursor.lastrowid
+        cursor = self._conn.execute(
+            """INSERT INTO chat_sessions
+               (start_time, current_model, title, description)
+               VALUES (?, ?, ?, ?)""",
+            (datetime.now(), model, title, description),
+        )
+        return cursor.lastrowid
 
     def get_session(self, session_id: int) -> Optional[ChatSession]:
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """SELECT id, start_time as "start_time [DATETIME]",
-                   current_model FROM chat_sessions WHERE id = ?""",
-                (session_id,),
-            )
-            session_data = cursor.fetchone()
-            if not session_data:
-                return None
-            cursor.execute(
-                """SELECT timestamp as "timestamp [DATETIME]",
-                   role, content, model
-                   FROM chat_messages
-                   WHERE session_id = ?
-                   ORDER BY timestamp""",
-                (session_id,),
-            )
-            messages = [
-                ChatMessage(role=row[1], content=row[2], timestamp=row[0], model=row[3])
-                for row in cursor.fetchall()
-            ]
-            return ChatSession(
-                id=session_data[0],
-                start_time=session_data[1],
-                current_model=session_data[2],
-                messages=messages,
-            )
+        self.flush()
+        session_data = self._conn.execute(
+            """SELECT id, start_time as "start_time [DATETIME]",
+               current_model FROM chat_sessions WHERE id = ?""",
+            (session_id,),
+        ).fetchone()
+        if not session_data:
+            return None
+        rows = self._conn.execute(
+            """SELECT timestamp as "timestamp [DATETIME]",
+               role, content, model
+               FROM chat_messages
+               WHERE session_id = ?
+               ORDER BY timestamp""",
+            (session_id,),
+        ).fetchall()
+        messages = [
+            ChatMessage(role=row[1], content=row[2], timestamp=row[0], model=row[3])
+            for row in rows
+        ]
+        return ChatSession(
+            id=session_data[0],
+            start_time=session_data[1],
+            current_model=session_data[2],
+            messages=messages,
+        )
 
     def get_all_sessions(self) -> List[Tuple[int, datetime, str, str]]:
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """SELECT id, start_time as "start_time [DATETIME]",
-                   current_model, title
-                   FROM chat_sessions
-                   ORDER BY start_time DESC"""
-            )
-            return cursor.fetchall()
-
-    def add_message(self, session_id: int, message: ChatMessage):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """INSERT INTO chat_messages
-                   (session_id, timestamp, role, content, model)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (
-                    session_id,
-                    message.timestamp,
-                    message.role,
-                    message.content,
-                    message.model,
-                ),
-            )
+        return self._conn.execute(
+            """SELECT id, start_time as "start_time [DATETIME]",
+               current_model, title
+               FROM chat_sessions
+               ORDER BY start_time DESC"""
+        ).fetchall()
+
+    def add_message_async(self, session_id: int, message: ChatMessage) -> Future:
+        future: Future = Future()
+        self._write_q.put(
+            (lambda conn: self._insert_message(conn, session_id, message), future)
+        )
+        return future
+
+    def _insert_message(
+        self, conn: sqlite3.Connection, session_id: int, message: ChatMessage
+    ):
+        conn.execute(
+            """INSERT INTO chat_messages
+               (session_id, timestamp, role, content, model)
+               VALUES (?, ?, ?, ?, ?)""",
+            (
+                session_id,
+                message.timestamp,
+                message.role,
+                message.content,
+                message.model,
+            ),
+        )
 
     def update_session_model(self, session_id: int, model: str):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE chat_sessions SET current_model = ? WHERE id = ?",
-                (model, session_id),
-            )
+        self._conn.execute(
+            "UPDATE chat_sessions SET current_model = ? WHERE id = ?",
+            (model, session_id),
+        )
 
     def update_session_title(self, session_id: int, new_title: str):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE chat_sessions SET title = ? WHERE id = ?",
-                (new_title, session_id),
-            )
+        self._conn.execute(
+            "UPDATE chat_sessions SET title = ? WHERE id = ?",
+            (new_title, session_id),
+        )
 
     def delete_session(self, session_id: int):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM chat_messages WHERE session_id = ?", (session_id,)
-            )
-            cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+        self.flush()
+        self._conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
@@ -1,11 +1,10 @@
 import os
-import yaml
 from chat_cli import ChatCLI
+from utils import load_yaml_cached
 
 
 def load_config(config_file="config.yaml"):
-    with open(config_file, "r") as f:
-        return yaml.safe_load(f)
+    return load_yaml_cached(config_file)
 
 
 def main():
@@ -0,0 +1,34 @@
+import json
+import os
+
+
+def load_yaml_cached(path: str):
+    cache_path = path + ".json"
+    try:
+        if os.path.getmtime(path) <= os.path.getmtime(cache_path):
+            with open(cache_path, "r") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    # Only a stale or missing cache needs PyYAML, so import it here
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+
+    with open(path, "r") as f:
+        data = yaml.load(f, Loader=Loader)
+    try:
+        # The cache may hold secrets (config.yaml has the API key), so give it
+        # the same permissions as the source file
+        mode = os.stat(path).st_mode & 0o777
+        fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+    except (OSError, TypeError):
+        # Cache is best effort; fall back to parsing YAML next time
+        pass
+    return data